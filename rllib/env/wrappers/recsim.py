@@ -8,18 +8,228 @@ https://github.com/google-research/recsim
 """
 
 from collections import OrderedDict
+from functools import lru_cache
 import gym
-from gym.spaces import Dict, Discrete, MultiDiscrete
+from gym.spaces import Box, Dict, Discrete, MultiDiscrete
 import numpy as np
-from recsim.document import AbstractDocumentSampler
-from recsim.simulator import environment, recsim_gym
-from recsim.user import AbstractUserModel, AbstractResponse
-from typing import Callable, List, Optional, Type
+import tree  # pip install dm_tree
+from types import MappingProxyType
+from typing import Any, Callable, List, Optional, Tuple, Type, TYPE_CHECKING
 
 from ray.rllib.env.env_context import EnvContext
 from ray.rllib.utils.annotations import override
 from ray.rllib.utils.error import UnsupportedSpaceException
-from ray.rllib.utils.spaces.space_utils import convert_element_to_space_type
+from ray.rllib.utils.spaces.space_utils import get_base_struct_from_space
+
+# RecSim (and its tensorflow dependency) is only imported once an env is
+# actually created, so that merely importing this module stays cheap.
+if TYPE_CHECKING:
+    from recsim.document import AbstractDocumentSampler
+    from recsim.user import AbstractUserModel, AbstractResponse
+
+
+def _fix_observation_space(obs_space: Dict) -> Tuple[Dict, Tuple[str, ...]]:
+    """Returns the RLlib-ready obs space and positional doc keys for `obs_space`.
+
+    The raw RecSim "doc" sub-space (keyed by document IDs) is reindexed by
+    the documents' positions. As the number of docs is fixed, the positional
+    keys are returned as well, so they don't have to be recomputed per step.
+
+    Note: The spaces are built from OrderedDicts on purpose, as gym's Dict
+    space would otherwise sort the keys (e.g. "10" before "2").
+    """
+    doc_keys = tuple(str(k) for k in range(len(obs_space["doc"].spaces)))
+    doc_space = Dict(OrderedDict(zip(doc_keys, obs_space["doc"].spaces.values())))
+    fixed_obs_space = Dict(
+        OrderedDict(
+            [
+                ("user", obs_space["user"]),
+                ("doc", doc_space),
+                ("response", obs_space["response"]),
+            ]
+        )
+    )
+    return fixed_obs_space, doc_keys
+
+
+# Up to this many Discrete actions, the MultiDiscrete decomposition of all
+# actions is precomputed into a lookup table. Beyond that (e.g. for large
+# slate sizes), actions are decoded on the fly to bound the table's memory.
+_MAX_ACTION_LUT_SIZE = 2 ** 16
+
+
+@lru_cache(maxsize=None)
+def _build_action_decoder(
+    action_space_dimensions: Tuple[int, ...]
+) -> Callable[[int], Tuple[int, ...]]:
+    """Returns a callable converting a Discrete action to a MultiDiscrete one.
+
+    The first sub-action is the least significant "digit" of the Discrete
+    action, hence the reversed dims (and coords) below. Either way, the
+    decoding happens in numpy rather than in a python divmod loop.
+
+    MultiDiscrete actions are returned as (immutable) tuples, which RecSim
+    accepts as slates just like lists. This allows the lookup table to hand
+    out its precomputed rows as-is, without any per-step allocation.
+
+    Decoders are cached per (hashable) `action_space_dimensions`, so all envs
+    with the same action space (e.g. all sub-envs of all workers in the same
+    process) share one decoder and lookup table.
+    """
+    dims_rev = action_space_dimensions[::-1]
+    num_actions = int(np.prod(action_space_dimensions))
+
+    if num_actions <= _MAX_ACTION_LUT_SIZE:
+        # Item `i` holds the MultiDiscrete action for Discrete action `i`.
+        coords = np.unravel_index(np.arange(num_actions), dims_rev)
+        lut = [tuple(row) for row in np.stack(coords[::-1], axis=1).tolist()]
+
+        def _decode(action):
+            return lut[action]
+
+    else:
+
+        def _decode(action):
+            return tuple(int(c) for c in np.unravel_index(int(action), dims_rev)[::-1])
+
+    return _decode
+
+
+def _discretize_action_space(
+    action_space: gym.Space, wrapper_name: str
+) -> Tuple[Tuple[int, ...], Discrete, Callable[[int], Tuple[int, ...]]]:
+    """Returns the dims, Discrete space and decoder for a MultiDiscrete space.
+
+    Args:
+        action_space: The MultiDiscrete action space to convert.
+        wrapper_name: The name of the converting wrapper (for error messages).
+
+    Returns:
+        A tuple of the action space's dimensions (as plain python ints, which
+        are cheaper to work with than numpy scalars), the equivalent Discrete
+        action space, and the callable decoding its actions.
+
+    Raises:
+        UnsupportedSpaceException: If `action_space` is not MultiDiscrete.
+    """
+    if not isinstance(action_space, MultiDiscrete):
+        raise UnsupportedSpaceException(
+            f"Action space {action_space} is not supported by {wrapper_name}"
+        )
+    action_space_dimensions = tuple(int(n) for n in action_space.nvec)
+    return (
+        action_space_dimensions,
+        Discrete(int(np.prod(action_space_dimensions))),
+        _build_action_decoder(action_space_dimensions),
+    )
+
+
+def _build_response_template(space_struct: Any) -> Any:
+    """Returns a fixed element of the space: All zeros, clipped into Box bounds.
+
+    Unlike `space.sample()`, this requires no RNG calls and can be computed
+    once upfront.
+    """
+
+    def _zero(leaf):
+        zeros = np.zeros(leaf.shape, dtype=leaf.dtype)
+        if isinstance(leaf, Box):
+            return np.asarray(np.clip(zeros, leaf.low, leaf.high), dtype=leaf.dtype)
+        return zeros
+
+    return tree.map_structure(_zero, space_struct)
+
+
+def _build_reset_response_fn(
+    response_space: gym.Space, cheap_reset_response: bool
+) -> Callable[[], Any]:
+    """Returns the callable producing the "response" for reset observations.
+
+    If `cheap_reset_response` is True, the zeros template is built once and
+    a fresh copy of it is returned on every call (no RNG calls at all), so
+    that consumers mutating a reset obs in place can't corrupt later resets.
+    Otherwise, a random response is sampled from `response_space`.
+    """
+    if cheap_reset_response:
+        zero_response = _build_response_template(
+            get_base_struct_from_space(response_space)
+        )
+        return lambda: tree.map_structure(np.copy, zero_response)
+    return response_space.sample
+
+
+def _cast_at_path(struct: Any, path: tuple, dtype: np.dtype) -> Any:
+    key, value = path[0], struct[path[0]]
+    if len(path) > 1:
+        new_value = _cast_at_path(value, path[1:], dtype)
+    elif not isinstance(value, np.ndarray) or value.dtype != dtype:
+        new_value = np.asarray(value, dtype=dtype)
+    else:
+        return struct
+
+    if new_value is value:
+        return struct
+    # Tuples are immutable -> Only rebuild them if one of their items changed.
+    elif isinstance(struct, tuple):
+        return struct[:key] + (new_value,) + struct[key + 1 :]
+    struct[key] = new_value
+    return struct
+
+
+def _needs_cast(struct: Any, path: tuple, dtype: np.dtype) -> bool:
+    for key in path:
+        struct = struct[key]
+    return not isinstance(struct, np.ndarray) or struct.dtype != dtype
+
+
+class _CastPlan:
+    """Casts the Box leaves of (nested) observations to their space's dtypes.
+
+    Walking the (nested) space once upfront allows us to cast observations
+    without recursing over them in every step. On the first call, all leaves
+    that already come in with the correct dtype are dropped from the plan
+    (RecSim emits the same dtype per leaf in every step), so later calls
+    don't touch the obs at all if nothing needs casting.
+    """
+
+    def __init__(self, space_struct: Any):
+        """Initializes a _CastPlan instance.
+
+        Args:
+            space_struct: The space's (nested) leaf spaces, as returned by
+                `get_base_struct_from_space()`. Passing the struct (rather
+                than the space) lets the wrappers below share one walk over
+                their observation space for all the plans they need.
+        """
+        self.entries: List[Tuple[tuple, np.dtype]] = [
+            (path, leaf.dtype)
+            for path, leaf in tree.flatten_with_path(space_struct)
+            if isinstance(leaf, Box)
+        ]
+        self._pruned = False
+
+    def __call__(self, obs: Any) -> Any:
+        if not self._pruned:
+            self.entries = [
+                (path, dtype)
+                for path, dtype in self.entries
+                if _needs_cast(obs, path, dtype)
+            ]
+            self._pruned = True
+        for path, dtype in self.entries:
+            obs = _cast_at_path(obs, path, dtype)
+        return obs
+
+
+def _fix_observation(
+    obs: dict, doc_keys: Tuple[str, ...], cast_plan: _CastPlan
+) -> dict:
+    """Reindexes a RecSim obs' docs by position and casts it to the space dtypes.
+
+    RecSim returns a fresh obs dict each call, so it is updated in place.
+    """
+    obs["doc"] = dict(zip(doc_keys, obs["doc"].values()))
+    return cast_plan(obs)
 
 
 class RecSimObservationSpaceWrapper(gym.ObservationWrapper):
@@ -36,33 +246,21 @@ class RecSimObservationSpaceWrapper(gym.ObservationWrapper):
 
     def __init__(self, env: gym.Env):
         super().__init__(env)
-        obs_space = self.env.observation_space
-        doc_space = Dict(
-            OrderedDict(
-                [
-                    (str(k), doc)
-                    for k, (_, doc) in enumerate(obs_space["doc"].spaces.items())
-                ]
-            )
-        )
-        self.observation_space = Dict(
-            OrderedDict(
-                [
-                    ("user", obs_space["user"]),
-                    ("doc", doc_space),
-                    ("response", obs_space["response"]),
-                ]
-            )
+        self.observation_space, self._doc_keys = _fix_observation_space(
+            self.env.observation_space
         )
-        self._sampled_obs = self.observation_space.sample()
+        space_struct = get_base_struct_from_space(self.observation_space)
+        self._cast_plan = _CastPlan(space_struct)
+        # Reset obs (incl. the response created by RecSimResetWrapper) may
+        # come in with other dtypes than step obs -> Prune their plan separately.
+        self._reset_cast_plan = _CastPlan(space_struct)
+
+    def reset(self, **kwargs):
+        obs = self.env.reset(**kwargs)
+        return _fix_observation(obs, self._doc_keys, self._reset_cast_plan)
 
     def observation(self, obs):
-        new_obs = OrderedDict()
-        new_obs["user"] = obs["user"]
-        new_obs["doc"] = {str(k): v for k, (_, v) in enumerate(obs["doc"].items())}
-        new_obs["response"] = obs["response"]
-        new_obs = convert_element_to_space_type(new_obs, self._sampled_obs)
-        return new_obs
+        return _fix_observation(obs, self._doc_keys, self._cast_plan)
 
 
 class RecSimResetWrapper(gym.Wrapper):
@@ -70,21 +268,36 @@ class RecSimResetWrapper(gym.Wrapper):
 
     RecSim's reset() function returns an observation without the "response"
     field, breaking RLlib's check. This wrapper fixes that by assigning a
-    random "response".
+    fixed all-zeros (or - if `cheap_reset_response=False` - a random)
+    "response". Agents typically don't learn from this response (the episode
+    has just started), so the cheap, constant one is used by default.
 
     RecSim's close() function raises NotImplementedError. We change the
     behavior to doing nothing.
     """
 
-    def __init__(self, env: gym.Env):
+    def __init__(self, env: gym.Env, cheap_reset_response: bool = True):
         super().__init__(env)
-        self._sampled_obs = self.env.observation_space.sample()
+        obs_space = self.env.observation_space
+        # Has the correct dtypes, so the response never needs casting.
+        self._response_space = obs_space["response"]
+        self._sample_response = _build_reset_response_fn(
+            self._response_space, cheap_reset_response
+        )
+        # The raw "doc" sub-space is keyed by (changing) document IDs, so we
+        # leave casting the docs to RecSimObservationSpaceWrapper.
+        self._cast_plan = _CastPlan(
+            {"user": get_base_struct_from_space(obs_space["user"])}
+        )
 
     def reset(self):
         obs = super().reset()
-        obs["response"] = self.env.observation_space["response"].sample()
-        obs = convert_element_to_space_type(obs, self._sampled_obs)
-        return obs
+        obs["response"] = self._sample_response()
+        return self._cast_plan(obs)
+
+    def seed(self, seed=None):
+        self._response_space.seed(seed)
+        return super().seed(seed)
 
     def close(self):
         pass
@@ -99,26 +312,99 @@ class MultiDiscreteToDiscreteActionWrapper(gym.ActionWrapper):
 
     def __init__(self, env: gym.Env):
         super().__init__(env)
+        (
+            self.action_space_dimensions,
+            self.action_space,
+            self._decode_action,
+        ) = _discretize_action_space(env.action_space, self.__class__.__name__)
 
-        if not isinstance(env.action_space, MultiDiscrete):
-            raise UnsupportedSpaceException(
-                f"Action space {env.action_space} "
-                f"is not supported by {self.__class__.__name__}"
-            )
-        self.action_space_dimensions = env.action_space.nvec
-        self.action_space = Discrete(np.prod(self.action_space_dimensions))
-
-    def action(self, action: int) -> List[int]:
+    def action(self, action: int) -> Tuple[int, ...]:
         """Convert a Discrete action to a MultiDiscrete action"""
-        multi_action = [None] * len(self.action_space_dimensions)
-        for idx, n in enumerate(self.action_space_dimensions):
-            action, dim_action = divmod(action, n)
-            multi_action[idx] = dim_action
-        return multi_action
+        return self._decode_action(action)
+
+
+class FusedRecSimWrapper(gym.Wrapper):
+    """All RecSim fixes above, fused into a single gym.Wrapper layer.
+
+    Applies the same fixes as RecSimResetWrapper, RecSimObservationSpaceWrapper
+    and (optionally) MultiDiscreteToDiscreteActionWrapper, but without
+    stacking three wrappers on top of each other. This saves several Python
+    call frames (and intermediate dicts) per step, which matters for RecSim,
+    where the underlying simulation step itself is very cheap.
+    """
+
+    def __init__(
+        self,
+        env: gym.Env,
+        convert_to_discrete_action_space: bool = False,
+        cheap_reset_response: bool = True,
+    ):
+        super().__init__(env)
+
+        self.observation_space, self._doc_keys = _fix_observation_space(
+            env.observation_space
+        )
+        space_struct = get_base_struct_from_space(self.observation_space)
+        self._cast_plan = _CastPlan(space_struct)
+        # On reset, we create the response ourselves (with the correct dtypes),
+        # so reset obs get their own plan, pruned independently from step's.
+        self._reset_cast_plan = _CastPlan(space_struct)
+        self._response_space = env.observation_space["response"]
+        self._sample_response = _build_reset_response_fn(
+            self._response_space, cheap_reset_response
+        )
+
+        self.action_space_dimensions = None
+        self._decode_action = None
+        if convert_to_discrete_action_space:
+            (
+                self.action_space_dimensions,
+                self.action_space,
+                self._decode_action,
+            ) = _discretize_action_space(env.action_space, self.__class__.__name__)
+
+    @override(gym.Wrapper)
+    def reset(self):
+        obs = self.env.reset()
+        obs["response"] = self._sample_response()
+        return _fix_observation(obs, self._doc_keys, self._reset_cast_plan)
+
+    @override(gym.Wrapper)
+    def step(self, action):
+        if self._decode_action is not None:
+            action = self._decode_action(action)
+        obs, reward, done, info = self.env.step(action)
+        obs = _fix_observation(obs, self._doc_keys, self._cast_plan)
+        return obs, reward, done, info
+
+    @override(gym.Wrapper)
+    def seed(self, seed=None):
+        self._response_space.seed(seed)
+        return self.env.seed(seed)
+
+    @override(gym.Wrapper)
+    def close(self):
+        pass
+
+
+# Default config values for envs created by `make_recsim_env()`. Keys set in
+# the user's EnvContext take precedence. Read-only, as it is shared by all envs.
+_DEFAULT_RECSIM_ENV_CONFIG = MappingProxyType(
+    {
+        "num_candidates": 10,
+        "slate_size": 2,
+        "resample_documents": True,
+        "seed": 0,
+        "convert_to_discrete_action_space": False,
+        "cheap_reset_response": True,
+    }
+)
 
 
 def recsim_gym_wrapper(
-    recsim_gym_env: gym.Env, convert_to_discrete_action_space: bool = False
+    recsim_gym_env: gym.Env,
+    convert_to_discrete_action_space: bool = False,
+    cheap_reset_response: bool = True,
 ) -> gym.Env:
     """Makes sure a RecSim gym.Env can ba handled by RLlib.
 
@@ -129,7 +415,7 @@ def recsim_gym_wrapper(
 
     Also, RecSim's reset() function returns an observation without the
     "response" field, breaking RLlib's check. This wrapper fixes that by
-    assigning a random "response".
+    assigning a fixed all-zeros (or a random) "response".
 
     Args:
         recsim_gym_env: The RecSim gym.Env instance. Usually resulting from a
@@ -142,27 +428,42 @@ def recsim_gym_wrapper(
             such as RLlib's DQN. If None, `convert_to_discrete_action_space`
             may also be provided via the EnvContext (config) when creating an
             actual env instance.
+        cheap_reset_response: Whether the "response" added to reset
+            observations should be a constant all-zeros one, built only
+            once (default), rather than being randomly sampled on each
+            reset. Agents typically don't learn from this response.
 
     Returns:
         An RLlib-ready gym.Env instance.
     """
-    env = RecSimResetWrapper(recsim_gym_env)
-    env = RecSimObservationSpaceWrapper(env)
-    if convert_to_discrete_action_space:
-        env = MultiDiscreteToDiscreteActionWrapper(env)
-    return env
+    return FusedRecSimWrapper(
+        recsim_gym_env, convert_to_discrete_action_space, cheap_reset_response
+    )
 
 
 def make_recsim_env(
-    recsim_user_model_creator: Callable[[EnvContext], AbstractUserModel],
-    recsim_document_sampler_creator: Callable[[EnvContext], AbstractDocumentSampler],
-    reward_aggregator: Callable[[List[AbstractResponse]], float],
+    recsim_user_model_creator: Callable[[EnvContext], "AbstractUserModel"],
+    recsim_document_sampler_creator: Callable[[EnvContext], "AbstractDocumentSampler"],
+    reward_aggregator: Callable[[List["AbstractResponse"]], float],
 ) -> Type[gym.Env]:
     """Creates a RLlib-ready gym.Env class given RecSim user and doc models.
 
     See https://github.com/google-research/recsim for more information on how to
     build the required components from scratch in python using RecSim.
 
+    The returned class takes an (optional) EnvContext with the following keys.
+    Missing keys are set to their defaults (in parentheses):
+    - `num_candidates` (10): Number of candidate documents per step.
+    - `slate_size` (2): Number of documents recommended per step.
+    - `resample_documents` (True): Whether to sample a new set of candidate
+        documents in each step.
+    - `seed` (0): Random seed, passed on to the user model and document sampler
+        creators via the EnvContext (offset per sub-env, see below).
+    - `convert_to_discrete_action_space` (False): Whether to convert the
+        MultiDiscrete action space into a Discrete one.
+    - `cheap_reset_response` (True): Whether to return an all-zeros response
+        on reset, rather than sampling one from the response space.
+
     Args:
         recsim_user_model_creator: A callable taking an EnvContext and returning
             a RecSim AbstractUserModel instance to use.
@@ -173,23 +474,35 @@ def make_recsim_env(
             AbstractResponse instances and returning a float (aggregated
             reward).
 
+    Observations are cast to the observation space's dtypes. To keep this
+    cheap, each observation leaf is only checked on the first reset and the
+    first step. Leaves that already have the correct dtype there are never
+    cast afterwards. The user and document models must therefore emit the
+    same dtype per observation leaf in every step, as RecSim's own models do.
+
+    The "seed" from the EnvContext is offset by the env's worker and vector
+    indices, so that all envs created via RLlib's `num_workers` and
+    `num_envs_per_worker` settings produce different user/doc streams.
+
     Returns:
         An RLlib-ready gym.Env class to use inside a Trainer.
     """
 
-    class _RecSimEnv(gym.Env):
+    class _RecSimEnv(FusedRecSimWrapper):
         def __init__(self, env_ctx: Optional[EnvContext] = None):
+            from recsim.simulator import environment, recsim_gym
+
             # Override with default values, in case they are not set by the user.
-            default_config = {
-                "num_candidates": 10,
-                "slate_size": 2,
-                "resample_documents": True,
-                "seed": 0,
-                "convert_to_discrete_action_space": False,
-            }
-            if env_ctx is None or isinstance(env_ctx, dict):
-                env_ctx = EnvContext(env_ctx or default_config, worker_index=0)
-            env_ctx.set_defaults(default_config)
+            env_config = {**_DEFAULT_RECSIM_ENV_CONFIG, **(env_ctx or {})}
+            if isinstance(env_ctx, EnvContext):
+                env_ctx = env_ctx.copy_with_overrides(env_config=env_config)
+            else:
+                env_ctx = EnvContext(env_config, worker_index=0)
+            # Give each (sub-)env across all workers its own seed, so that they
+            # don't all produce the same user/doc streams. Same scheme as
+            # RolloutWorker's env seeding (at most 1000 sub-envs per worker).
+            if env_ctx["seed"] is not None:
+                env_ctx["seed"] += 1000 * env_ctx.worker_index + env_ctx.vector_index
 
             # Create the RecSim user model instance.
             recsim_user_model = recsim_user_model_creator(env_ctx)
@@ -208,27 +521,12 @@ def make_recsim_env(
             gym_env = recsim_gym.RecSimGymEnv(raw_recsim_env, reward_aggregator)
 
             # Fix observation space and - if necessary - convert to discrete
-            # action space (from multi-discrete).
-            self.env = recsim_gym_wrapper(
-                gym_env, env_ctx["convert_to_discrete_action_space"]
+            # action space (from multi-discrete). We are the fused wrapper
+            # ourselves, so no extra forwarding layer is needed.
+            super().__init__(
+                gym_env,
+                env_ctx["convert_to_discrete_action_space"],
+                env_ctx["cheap_reset_response"],
             )
-            self.observation_space = self.env.observation_space
-            self.action_space = self.env.action_space
-
-        @override(gym.Env)
-        def reset(self):
-            return self.env.reset()
-
-        @override(gym.Env)
-        def step(self, actions):
-            return self.env.step(actions)
-
-        @override(gym.Env)
-        def seed(self, seed=None):
-            return self.env.seed(seed)
-
-        @override(gym.Env)
-        def render(self, mode="human"):
-            return self.env.render(mode)
 
     return _RecSimEnv
@@ -1,10 +1,19 @@
 import gym
+import numpy as np
 import unittest
 
 from ray.rllib.examples.env.recsim_recommender_system_envs import (
     InterestEvolutionRecSimEnv,
 )
-from ray.rllib.env.wrappers.recsim import MultiDiscreteToDiscreteActionWrapper
+from ray.rllib.env.env_context import EnvContext
+from ray.rllib.env.wrappers.recsim import (
+    MultiDiscreteToDiscreteActionWrapper,
+    _build_action_decoder,
+    _build_reset_response_fn,
+    _CastPlan,
+    _MAX_ACTION_LUT_SIZE,
+)
+from recsim.simulator import recsim_gym
 from ray.rllib.utils.error import UnsupportedSpaceException
 
 
@@ -19,6 +28,54 @@ class TestRecSimWrapper(unittest.TestCase):
         new_obs, _, _, _ = env.step(env.action_space.sample())
         self.assertTrue(env.observation_space.contains(new_obs))
 
+    def test_unwrapped(self):
+        env = InterestEvolutionRecSimEnv()
+        self.assertIsInstance(env.unwrapped, recsim_gym.RecSimGymEnv)
+
+    def test_random_reset_response(self):
+        env = InterestEvolutionRecSimEnv({"cheap_reset_response": False})
+        for _ in range(3):
+            obs = env.reset()
+            self.assertTrue(env.observation_space.contains(obs))
+
+    def test_cheap_reset_response_is_not_shared(self):
+        space = gym.spaces.Tuple(
+            [gym.spaces.Dict({"watch_time": gym.spaces.Box(0.0, 1.0, (2,))})]
+        )
+        sample_response = _build_reset_response_fn(space, cheap_reset_response=True)
+        response = sample_response()
+        response[0]["watch_time"][:] = 1.0
+        self.assertTrue(np.all(sample_response()[0]["watch_time"] == 0.0))
+
+    def test_sub_envs_are_seeded_differently(self):
+        obs = [
+            InterestEvolutionRecSimEnv(
+                EnvContext({}, worker_index=worker_index, vector_index=vector_index)
+            ).reset()
+            for worker_index, vector_index in [(0, 0), (0, 1), (1, 0)]
+        ]
+        for other_obs in obs[1:]:
+            self.assertFalse(
+                all(
+                    np.array_equal(obs[0]["doc"][k], other_obs["doc"][k])
+                    for k in obs[0]["doc"]
+                )
+            )
+
+    def test_cast_plan_only_keeps_leaves_that_need_casting(self):
+        cast_plan = _CastPlan(
+            {
+                "a": gym.spaces.Box(0.0, 1.0, (2,), np.float32),
+                "b": gym.spaces.Box(0.0, 1.0, (2,), np.float32),
+            }
+        )
+        obs = cast_plan({"a": np.zeros(2, np.float64), "b": np.zeros(2, np.float32)})
+        self.assertEqual(cast_plan.entries, [(("a",), np.float32)])
+        self.assertEqual(obs["a"].dtype, np.float32)
+        obs = cast_plan({"a": np.ones(2, np.float64), "b": np.ones(2, np.float32)})
+        self.assertEqual(obs["a"].dtype, np.float32)
+        self.assertEqual(obs["b"].dtype, np.float32)
+
     def test_action_space_conversion(self):
         env = InterestEvolutionRecSimEnv({"convert_to_discrete_action_space": True})
         self.assertIsInstance(env.action_space, gym.spaces.Discrete)
@@ -28,6 +85,33 @@ class TestRecSimWrapper(unittest.TestCase):
         new_obs, _, _, _ = env.step(action)
         self.assertTrue(env.observation_space.contains(new_obs))
 
+    def test_action_space_conversion_matches_divmod(self):
+        env = MultiDiscreteToDiscreteActionWrapper(InterestEvolutionRecSimEnv())
+        for action in range(env.action_space.n):
+            expected = []
+            remainder = action
+            for n in env.action_space_dimensions:
+                remainder, dim_action = divmod(remainder, n)
+                expected.append(dim_action)
+            self.assertEqual(list(env.action(action)), expected)
+
+    def test_action_decoding_without_lookup_table(self):
+        # Too many Discrete actions for a lookup table -> Decoded on the fly.
+        dims = (_MAX_ACTION_LUT_SIZE, 3, 2)
+        decode = _build_action_decoder(dims)
+        for action in [0, 1, _MAX_ACTION_LUT_SIZE + 5, 6 * _MAX_ACTION_LUT_SIZE - 1]:
+            expected = []
+            remainder = action
+            for n in dims:
+                remainder, dim_action = divmod(remainder, n)
+                expected.append(dim_action)
+            self.assertEqual(list(decode(action)), expected)
+
+    def test_action_decoder_is_shared_across_envs(self):
+        env_1 = MultiDiscreteToDiscreteActionWrapper(InterestEvolutionRecSimEnv())
+        env_2 = MultiDiscreteToDiscreteActionWrapper(InterestEvolutionRecSimEnv())
+        self.assertIs(env_1._decode_action, env_2._decode_action)
+
     def test_double_action_space_conversion_raises_exception(self):
         env = InterestEvolutionRecSimEnv({"convert_to_discrete_action_space": True})
         with self.assertRaises(UnsupportedSpaceException):